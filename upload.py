@@ -1,21 +1,39 @@
 #!/usr/bin/env python3
 import argparse
+import logging
+import re
 import requests
 import sys
 import os
-from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from datetime import date
+from urllib.parse import urlparse
+
+
+# Fast-path patterns for pulling the CSRF token straight out of the raw form page
+_FORM_RE = re.compile(rb'<form[^>]+action="/admin/uploads"')
+_TOKEN_RE = re.compile(rb'name="authenticity_token"[^>]*value="([^"]+)"')
+
+# Rails responds with one of these when it rejects a stale authenticity token
+_INVALID_TOKEN_MARKERS = ('InvalidAuthenticityToken', 'The change you wanted was rejected')
+
+# A redirect whose path contains one of these means the session was not accepted
+_AUTH_REDIRECT_MARKERS = ('sign_in', 'login', '/admin/uploads/new')
+
+CSRF_TOKEN_FILE = '.lml_csrf_token'
+
+# Restrict the BeautifulSoup fallback to the upload form subtree
+_ONLY_UPLOAD_FORM = SoupStrainer('form', attrs={'action': '/admin/uploads'})
 
 
 def get_monday_of_current_week():
     """Get the date of Monday for the current week."""
-    today = datetime.now()
-    # Get the day of the week as an integer (0 is Monday, 6 is Sunday)
-    weekday = today.weekday()
-    # Calculate the date of Monday by subtracting the weekday number
-    monday = today - timedelta(days=weekday)
+    # Ordinal 1 (0001-01-01) is a Monday, so (ordinal + 6) % 7 is the weekday (0 is Monday)
+    today = date.today().toordinal()
+    monday = date.fromordinal(today - (today + 6) % 7)
     # Format as YYYY-MM-DD
-    return monday.strftime("%Y-%m-%d")
+    return monday.isoformat()
 
 
 def default_source_name():
@@ -28,7 +46,7 @@ def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Upload data to LML Rails admin endpoint.')
     parser.add_argument('-s', '--source', help='Source label for the upload')
-    parser.add_argument('-c', '--content', required=True, help='Path to content file')
+    parser.add_argument('-c', '--content', required=True, nargs='+', help='Path(s) to content file(s); multiple files are uploaded over one session')
     parser.add_argument('-u', '--url', default='https://api.lml.live', help='Base URL of the Rails application')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     
@@ -43,9 +61,9 @@ def parse_arguments():
 
 
 def load_content_file(filename):
-    """Load content from a file."""
+    """Load raw content bytes from a file, skipping the decode/re-encode round trip."""
     try:
-        with open(filename, 'r') as f:
+        with open(filename, 'rb') as f:
             content = f.read()
         return content
     except FileNotFoundError:
@@ -72,24 +90,72 @@ def load_session_id():
         sys.exit(1)
 
 
-def get_csrf_token(session, url, verbose=False):
-    """Fetch a new CSRF token from the form page."""
-    form_url = f"{url.rstrip('/')}/admin/uploads/new"
+def load_cached_token():
+    """Load a previously fetched CSRF token, if one has been cached."""
+    try:
+        with open(CSRF_TOKEN_FILE, 'r') as f:
+            token = f.read().strip()
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Warning: Could not read cached CSRF token: {e}")
+        return None
+    if token:
+        print(f"Loaded cached CSRF token from {CSRF_TOKEN_FILE}")
+    return token or None
+
+
+def save_cached_token(token):
+    """Cache a CSRF token so later runs can skip fetching the form page."""
+    try:
+        with open(CSRF_TOKEN_FILE, 'w') as f:
+            f.write(token)
+    except Exception as e:
+        print(f"Warning: Could not cache CSRF token: {e}")
+
+
+def clear_cached_token():
+    """Remove the cached CSRF token after the server has rejected it."""
+    try:
+        os.remove(CSRF_TOKEN_FILE)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Warning: Could not remove cached CSRF token: {e}")
+
+
+def get_csrf_token(session, base_url, verbose=False):
+    """Fetch a new CSRF token from the form page (base_url has no trailing slash)."""
+    form_url = f"{base_url}/admin/uploads/new"
     print(f"Fetching CSRF token from {form_url}")
     
     try:
         response = session.get(form_url)
         response.raise_for_status()
         
+        # Try a plain regex over the raw bytes first; only build a DOM if it misses
+        body = response.content
+        # Search for the token only inside the upload form, so another form's
+        # per-form token (e.g. the nav's logout button) is never picked up
+        form_match = _FORM_RE.search(body)
+        form_end = body.find(b'</form>', form_match.end()) if form_match else -1
+        if form_end != -1:
+            match = _TOKEN_RE.search(body, form_match.end(), form_end)
+            if match:
+                token = match.group(1).decode('ascii')
+                print(f"Found CSRF token: {token[:10]}...{token[-10:]} (truncated)")
+                return token
+        
         # Check if we're on the right page by verifying the form exists
-        soup = BeautifulSoup(response.text, 'html.parser')
+        # (bs4 gets the raw bytes so lxml sniffs the encoding, not requests)
+        soup = BeautifulSoup(body, 'lxml', parse_only=_ONLY_UPLOAD_FORM)
         form = soup.find('form', {'action': '/admin/uploads'})
         
         if not form:
             print("Error: Could not find the upload form. You may not be authenticated properly.")
             if verbose:
                 print("Response HTML (first 500 chars):")
-                print(response.text[:500] + "..." if len(response.text) > 500 else response.text)
+                print(body[:500].decode('utf-8', 'replace') + ("..." if len(body) > 500 else ""))
             sys.exit(1)
         
         # Extract token using BeautifulSoup
@@ -103,7 +169,7 @@ def get_csrf_token(session, url, verbose=False):
         print("Error: Could not find CSRF token in the page")
         if verbose:
             print("Response HTML (first 500 chars):")
-            print(response.text[:500] + "..." if len(response.text) > 500 else response.text)
+            print(body[:500].decode('utf-8', 'replace') + ("..." if len(body) > 500 else ""))
         sys.exit(1)
         
     except requests.exceptions.RequestException as e:
@@ -111,22 +177,35 @@ def get_csrf_token(session, url, verbose=False):
         sys.exit(1)
 
 
-def submit_to_rails(url, source, content, session, verbose=False):
-    """Submit data to Rails endpoint using essential headers."""
-    # Construct the full URL
-    endpoint = f"{url.rstrip('/')}/admin/uploads"
+def submit_to_rails(url, source, content, session, verbose=False, csrf_token=None, use_cached_token=True):
+    """Submit data to Rails endpoint using essential headers.
+
+    Uses csrf_token if given, else the cached token, else fetches one. If Rails
+    rejects a token that was not freshly fetched (or redirects to sign-in), the
+    cache is cleared and the upload is retried once with a new token, which also
+    re-checks authentication. Returns (success, token used) so callers can reuse
+    the token for further uploads.
+    """
+    # Strip the trailing slash once and derive every URL from it
+    base = url.rstrip('/')
+    endpoint = f"{base}/admin/uploads"
     
-    # Set only essential headers
+    # Set only essential headers; requests supplies the multipart content-type and boundary
     headers = {
         'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'content-type': 'application/x-www-form-urlencoded',
-        'origin': url,
-        'referer': f"{url.rstrip('/')}/admin/uploads/new",
+        'connection': 'keep-alive',
+        'origin': base,
+        'referer': f"{base}/admin/uploads/new",
         'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
     }
     
-    # Get CSRF token first
-    csrf_token = get_csrf_token(session, url, verbose)
+    # Reuse the caller's or the cached CSRF token if there is one, otherwise fetch a fresh one
+    if csrf_token is None and use_cached_token:
+        csrf_token = load_cached_token()
+    token_reused = csrf_token is not None
+    if not token_reused:
+        csrf_token = get_csrf_token(session, base, verbose)
+        save_cached_token(csrf_token)
     
     # Prepare form data
     form_data = {
@@ -145,70 +224,113 @@ def submit_to_rails(url, source, content, session, verbose=False):
         for key, value in headers.items():
             print(f"  {key}: {value}")
         print("Form Data:")
+        # Decode only the slice that gets printed, never the whole blob
+        content_preview = content[:100].decode('utf-8', 'replace')
+        if len(content) > 100:
+            content_preview += '... (truncated)'
         for key, value in form_data.items():
-            if key == 'lml_upload[content]' and len(str(value)) > 100:
-                print(f"  {key}: {str(value)[:100]}... (truncated)")
+            if key == 'lml_upload[content]':
+                print(f"  {key}: {content_preview}")
             elif key == 'authenticity_token':
                 print(f"  {key}: {value[:10]}...{value[-10:]} (truncated)")
             else:
                 print(f"  {key}: {value}")
     
+    # Send as multipart/form-data so the content blob goes out as-is rather than
+    # being percent-encoded; no filename keeps it a plain string param in Rails
+    fields = {key: value for key, value in form_data.items() if key != 'lml_upload[content]'}
+    files = {'lml_upload[content]': (None, content)}
+    
     # Make the request
     try:
-        response = session.post(endpoint, data=form_data, headers=headers, allow_redirects=False)
+        response = session.post(endpoint, data=fields, files=files, headers=headers, allow_redirects=False)
+        # Only decode the body where it is actually read (verbose output, 422 handling)
+        body = None
         
         if verbose:
+            body = response.text
             print("\n=== Response Details ===")
             print(f"Status Code: {response.status_code}")
             print("Response Headers:")
             for key, value in response.headers.items():
                 print(f"  {key}: {value}")
             
-            if len(response.text) > 0:
+            if len(body) > 0:
                 print(f"Response Body (first 500 chars):")
-                print(response.text[:500] + "..." if len(response.text) > 500 else response.text)
+                print(body[:500] + "..." if len(body) > 500 else body)
         
         # Success is often indicated by a 302 redirect in Rails
         if response.status_code == 302:
             redirect_url = response.headers.get('Location')
+            
+            # With a reused token the form page was never fetched, so nothing has
+            # checked the session yet; a bounce to sign-in is a failure, not success
+            redirect_path = urlparse(redirect_url or '').path
+            if token_reused and any(marker in redirect_path for marker in _AUTH_REDIRECT_MARKERS):
+                print(f"Redirected to {redirect_url}; re-checking the session with a fresh CSRF token")
+                clear_cached_token()
+                return submit_to_rails(url, source, content, session, verbose, use_cached_token=False)
+            
             print(f"Success! Redirected to: {redirect_url}")
-            return True
+            return True, csrf_token
         elif response.status_code in [200, 201]:
             print(f"Success! Status code: {response.status_code}")
-            return True
+            return True, csrf_token
         else:
             print(f"Unexpected status code: {response.status_code}")
             
-            # Try to parse response for potential error messages
             if response.status_code == 422:
-                soup = BeautifulSoup(response.text, 'html.parser')
+                if body is None:
+                    body = response.text
+                
+                # A stale reused token gets one retry with a fresh token
+                if token_reused and any(marker in body for marker in _INVALID_TOKEN_MARKERS):
+                    print("Reused CSRF token was rejected; fetching a new one and retrying")
+                    clear_cached_token()
+                    return submit_to_rails(url, source, content, session, verbose, use_cached_token=False)
+                
+                # Try to parse response for potential error messages
+                soup = BeautifulSoup(body, 'lxml')
                 error_messages = soup.select('.error_messages, .alert, .flash, .field_with_errors')
                 if error_messages:
                     print("\nError messages found in response:")
                     for error in error_messages:
                         print(f"  - {error.get_text().strip()}")
             
-            return False
+            return False, csrf_token
             
     except requests.exceptions.RequestException as e:
         print(f"Error sending request: {e}")
         
-        if hasattr(e, 'response') and e.response is not None:
-            print(f"Response status: {e.response.status_code}")
-            print(f"Response body: {e.response.text[:500]}..." if len(e.response.text) > 500 else f"Response body: {e.response.text}")
+        resp = getattr(e, 'response', None)
+        if resp is not None:
+            error_body = resp.text
+            print(f"Response status: {resp.status_code}")
+            print(f"Response body: {error_body[:500]}..." if len(error_body) > 500 else f"Response body: {error_body}")
         
-        return False
+        return False, csrf_token
 
 
 def main():
     """Main function to run the script."""
     args = parse_arguments()
     
-    # Load content from file
-    content = load_content_file(args.content)
+    # urllib3 logs "Starting new HTTPS connection" once per real connect, which
+    # shows whether the CSRF fetch and the uploads shared a kept-alive socket
+    if args.verbose:
+        logging.basicConfig(format='%(name)s: %(message)s')
+        logging.getLogger('urllib3').setLevel(logging.DEBUG)
     
-    # Create a session
+    # Check every content file up front so a bad path can't cut a batch short
+    missing = [filename for filename in args.content if not os.path.isfile(filename)]
+    if missing:
+        for filename in missing:
+            print(f"Error: File {filename} not found.")
+        sys.exit(1)
+    
+    # Create a session; the CSRF fetch and the uploads reuse one keep-alive connection
     session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
     
     # Set up session cookie
     session_id = load_session_id()
@@ -216,14 +338,23 @@ def main():
     
     print(f"\nSubmitting data to {args.url}/admin/uploads")
     print(f"Source: {args.source}")
-    print(f"Content file: {args.content}")
     
-    result = submit_to_rails(args.url, args.source, content, session, args.verbose)
+    # The CSRF token is fetched (or loaded from cache) by the first upload and
+    # kept in memory for the rest; the cache file only carries it between runs
+    csrf_token = None
+    failed = []
+    for filename in args.content:
+        print(f"\nContent file: {filename}")
+        content = load_content_file(filename)
+        
+        result, csrf_token = submit_to_rails(args.url, args.source, content, session, args.verbose, csrf_token)
+        if not result:
+            failed.append(filename)
     
-    if result:
-        print("\nUpload completed successfully!")
+    if not failed:
+        print("\nUpload completed successfully!" if len(args.content) == 1 else f"\nAll {len(args.content)} uploads completed successfully!")
     else:
-        print("\nUpload failed.")
+        print(f"\nUpload failed for: {', '.join(failed)}")
         sys.exit(1)
 
 